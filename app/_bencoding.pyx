@@ -0,0 +1,153 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled counterpart of the hot paths in app/bencoding.py.
+# Build in place with: cythonize -i app/_bencoding.pyx
+
+cdef enum:
+    BYTE_I = 105  # i
+    BYTE_L = 108  # l
+    BYTE_D = 100  # d
+    BYTE_E = 101  # e
+    BYTE_0 = 48  # 0
+    BYTE_9 = 57  # 9
+    BYTE_COL = 58  # :
+    BYTE_MINUS = 45  # -
+
+# More digits than this may overflow a long long
+cdef Py_ssize_t MAX_FAST_DIGITS = 18
+
+
+cdef Py_ssize_t _find(const unsigned char *buf, Py_ssize_t size, Py_ssize_t start, unsigned char byte) except -2:
+    cdef Py_ssize_t i = start
+    while i < size:
+        if buf[i] == byte:
+            return i
+        i += 1
+    raise ValueError(f"Missing '{chr(byte)}'")
+
+
+cdef object _parse_uint(const unsigned char *buf, Py_ssize_t start, Py_ssize_t end):
+    cdef long long n = 0
+    cdef unsigned char digit
+    cdef Py_ssize_t i
+    if start >= end:
+        raise ValueError("Empty integer")
+    if end - start > MAX_FAST_DIGITS:
+        return int(buf[start:end])
+    for i in range(start, end):
+        digit = buf[i] - BYTE_0
+        if digit > 9:
+            raise ValueError(f"Invalid digit '{chr(buf[i])}'")
+        n = n * 10 + digit
+    return n
+
+
+cdef object _parse_int(const unsigned char *buf, Py_ssize_t start, Py_ssize_t end):
+    if start < end and buf[start] == BYTE_MINUS:
+        return -_parse_uint(buf, start + 1, end)
+    return _parse_uint(buf, start, end)
+
+
+def _decode_bencode_impl(
+    input, Py_ssize_t start_idx, bint zero_copy=False, bint keys_as_bytes=False
+):
+    # Any contiguous buffer: bytes, bytearray or memoryview
+    cdef const unsigned char[::1] data = input
+    cdef Py_ssize_t size = data.shape[0]
+    if start_idx >= size:
+        raise IndexError("index out of range")
+    cdef const unsigned char *buf = &data[0]
+    cdef Py_ssize_t idx = start_idx
+    cdef Py_ssize_t end_idx, col_idx, length
+    cdef unsigned char prefix
+    cdef list stack = []
+    cdef list top
+    cdef object value
+    cdef object view = memoryview(input) if zero_copy else None
+
+    # Stack entries are [False, list, None] or [True, dict, pending_key]
+    while True:
+        if idx >= size:
+            raise IndexError("index out of range")
+        prefix = buf[idx]
+        if prefix == BYTE_I:
+            end_idx = _find(buf, size, idx + 2, BYTE_E)
+            value = _parse_int(buf, idx + 1, end_idx)
+            idx = end_idx + 1
+        elif BYTE_0 <= prefix <= BYTE_9:
+            col_idx = _find(buf, size, idx + 1, BYTE_COL)
+            if col_idx - idx > MAX_FAST_DIGITS:
+                # Would not fit a Py_ssize_t, and no input is that long anyway
+                raise ValueError("String longer than input")
+            length = _parse_uint(buf, idx, col_idx)
+            end_idx = col_idx + 1 + length
+            if end_idx > size:
+                raise ValueError("String longer than input")
+            if zero_copy:
+                value = view[col_idx + 1 : end_idx]
+            else:
+                value = input[col_idx + 1 : end_idx]
+            idx = end_idx
+        elif prefix == BYTE_L:
+            stack.append([False, [], None])
+            idx += 1
+            continue
+        elif prefix == BYTE_D:
+            stack.append([True, {}, None])
+            idx += 1
+            continue
+        elif prefix == BYTE_E and stack:
+            value = (<list>stack.pop())[1]
+            idx += 1
+        else:
+            raise ValueError(f"Unknown prefix '{chr(prefix)}'")
+
+        if not stack:
+            return (value, idx)
+
+        top = <list>stack[len(stack) - 1]
+        if not top[0]:
+            (<list>top[1]).append(value)
+        elif top[2] is None:
+            if keys_as_bytes:
+                if type(value) is memoryview:
+                    value = bytes(value)
+            elif isinstance(value, (bytes, memoryview)):
+                value = str(value, "utf-8")
+            top[2] = value
+        else:
+            (<dict>top[1])[top[2]] = value
+            top[2] = None
+
+
+def _sort_key(tuple item):
+    key = item[0]
+    return (<str>key).encode() if type(key) is str else key
+
+
+def encode_bencode_into(value, out):
+    cdef type value_type = type(value)
+    if value_type is int:
+        out(b"i%de" % value)
+    elif value_type is bytes:
+        out(b"%d:" % len(<bytes>value))
+        out(value)
+    elif value_type is memoryview:
+        out(b"%d:" % value.nbytes)
+        out(value)
+    elif value_type is str:
+        value_b = (<str>value).encode()
+        out(b"%d:" % len(value_b))
+        out(value_b)
+    elif value_type is list:
+        out(b"l")
+        for item in <list>value:
+            encode_bencode_into(item, out)
+        out(b"e")
+    elif value_type is dict:
+        out(b"d")
+        for key, item_value in sorted((<dict>value).items(), key=_sort_key):
+            encode_bencode_into(key, out)
+            encode_bencode_into(item_value, out)
+        out(b"e")
+    else:
+        raise TypeError(f"Can't bencode type {type(value)}")
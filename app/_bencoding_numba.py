@@ -0,0 +1,156 @@
+import numpy as np
+from numba import njit
+
+TOKEN_INT = 0
+TOKEN_BIGINT = 1
+TOKEN_BYTES = 2
+TOKEN_LIST = 3
+TOKEN_DICT = 4
+
+# More digits than this may overflow an int64
+MAX_FAST_DIGITS = 18
+
+
+@njit(cache=True)
+def tokenize(buf, start_idx):
+    size = len(buf)
+    # Every token takes at least two bytes ("0:", "le", "i0e")
+    max_tokens = (size - start_idx) // 2 + 1
+    types = np.empty(max_tokens, np.int8)
+    starts = np.empty(max_tokens, np.int64)
+    ends = np.empty(max_tokens, np.int64)
+    values = np.empty(max_tokens, np.int64)
+    parents = np.empty(max_tokens, np.int32)
+    open_tokens = np.empty(max_tokens, np.int32)
+    depth = 0
+    count = 0
+    idx = start_idx
+    while True:
+        if idx >= size:
+            raise IndexError("index out of range")
+        prefix = buf[idx]
+        parent = open_tokens[depth - 1] if depth > 0 else -1
+        if prefix == 101 and depth > 0:  # e
+            depth -= 1
+            ends[open_tokens[depth]] = idx + 1
+            idx += 1
+            if depth == 0:
+                return types, starts, ends, values, parents, count, idx
+            continue
+
+        if count == max_tokens:
+            # Only unterminated containers can get here
+            raise IndexError("index out of range")
+        token = count
+        count += 1
+        types[token] = -1
+        starts[token] = idx
+        parents[token] = parent
+        if prefix == 105:  # i
+            end_idx = idx + 2
+            while end_idx < size and buf[end_idx] != 101:
+                end_idx += 1
+            if end_idx >= size:
+                raise ValueError("Missing 'e'")
+            digits_idx = idx + 1
+            negative = buf[digits_idx] == 45  # -
+            if negative:
+                digits_idx += 1
+            if digits_idx >= end_idx:
+                raise ValueError("Empty integer")
+            n = 0
+            for i in range(digits_idx, end_idx):
+                digit = buf[i] - 48
+                if digit < 0 or digit > 9:
+                    raise ValueError("Invalid digit")
+                n = n * 10 + digit
+                if i - digits_idx >= MAX_FAST_DIGITS:
+                    types[token] = TOKEN_BIGINT
+            if types[token] != TOKEN_BIGINT:
+                types[token] = TOKEN_INT
+                values[token] = -n if negative else n
+            starts[token] = idx + 1
+            ends[token] = end_idx
+            idx = end_idx + 1
+        elif 48 <= prefix <= 57:  # 0-9
+            col_idx = idx + 1
+            while col_idx < size and buf[col_idx] != 58:  # :
+                col_idx += 1
+            if col_idx >= size:
+                raise ValueError("Missing ':'")
+            if col_idx - idx > MAX_FAST_DIGITS:
+                # Would overflow, and no input is that long anyway
+                raise ValueError("String longer than input")
+            length = 0
+            for i in range(idx, col_idx):
+                digit = buf[i] - 48
+                if digit < 0 or digit > 9:
+                    raise ValueError("Invalid digit")
+                length = length * 10 + digit
+            if col_idx + 1 + length > size:
+                raise ValueError("String longer than input")
+            types[token] = TOKEN_BYTES
+            starts[token] = col_idx + 1
+            ends[token] = col_idx + 1 + length
+            idx = ends[token]
+        elif prefix == 108 or prefix == 100:  # l, d
+            types[token] = TOKEN_LIST if prefix == 108 else TOKEN_DICT
+            open_tokens[depth] = token
+            depth += 1
+            idx += 1
+            continue
+        else:
+            raise ValueError("Unknown prefix")
+
+        if depth == 0:
+            return types, starts, ends, values, parents, count, idx
+
+
+def _decode_bencode_impl(
+    input: bytes,
+    start_idx: int,
+    zero_copy: bool = False,
+    keys_as_bytes: bool = False,
+) -> tuple[int | bytes | memoryview | list | dict, int]:
+    buf = np.frombuffer(input, dtype=np.uint8)
+    types, starts, ends, values, parents, count, end_idx = tokenize(buf, start_idx)
+    view = memoryview(input)
+    objs: list = [None] * count
+    pending_keys: dict[int, object] = {}
+    for token, (token_type, start, end, value, parent) in enumerate(
+        zip(
+            types[:count].tolist(),
+            starts[:count].tolist(),
+            ends[:count].tolist(),
+            values[:count].tolist(),
+            parents[:count].tolist(),
+        )
+    ):
+        if token_type == TOKEN_INT:
+            obj = value
+        elif token_type == TOKEN_BYTES:
+            obj = view[start:end] if zero_copy else input[start:end]
+        elif token_type == TOKEN_LIST:
+            obj = objs[token] = []
+        elif token_type == TOKEN_DICT:
+            obj = objs[token] = {}
+        else:
+            obj = int(input[start:end])
+
+        if parent < 0:
+            continue
+        container = objs[parent]
+        if type(container) is list:
+            container.append(obj)
+        elif parent not in pending_keys:
+            if keys_as_bytes:
+                if type(obj) is memoryview:
+                    obj = bytes(obj)
+            elif isinstance(obj, (bytes, memoryview)):
+                obj = str(obj, "utf-8")
+            pending_keys[parent] = obj
+        else:
+            container[pending_keys.pop(parent)] = obj
+
+    root = objs[0] if types[0] in (TOKEN_LIST, TOKEN_DICT) else obj
+    return (root, end_idx)
@@ -1,3 +1,6 @@
+from os import environ
+from typing import Callable
+
 BYTE_I = ord(b"i")
 BYTE_L = ord(b"l")
 BYTE_D = ord(b"d")
@@ -6,67 +9,160 @@ BYTE_0 = ord(b"0")
 BYTE_9 = ord(b"9")
 BYTE_COL = ord(b":")
 
+# Same limit as the compiled decoders, which parse lengths into 64-bit ints
+MAX_LENGTH_DIGITS = 18
+
+
+def decode_bencode(
+    bencoded_value: bytes, zero_copy: bool = False, keys_as_bytes: bool = False
+) -> int | bytes | memoryview | list | dict:
+    return _decode_bencode_impl(bencoded_value, 0, zero_copy, keys_as_bytes)[0]
+
 
-def decode_bencode(bencoded_value: bytes) -> int | bytes | list | dict:
-    return _decode_bencode_impl(bencoded_value, 0)[0]
+def decode_bencode_dict_with_spans(
+    bencoded_value: bytes, zero_copy: bool = False, keys_as_bytes: bool = False
+) -> tuple[dict, dict[str | bytes, tuple[int, int]]]:
+    # Also returns where each top-level value lies in the input
+    if bencoded_value[0] != BYTE_D:
+        raise ValueError("Not a bencoded dict")
+    values: dict = {}
+    spans: dict[str | bytes, tuple[int, int]] = {}
+    idx = 1
+    while bencoded_value[idx] != BYTE_E:
+        key, start_idx = _decode_bencode_impl(bencoded_value, idx)
+        if type(key) is not bytes:
+            raise ValueError("Dict key is not a string")
+        if not keys_as_bytes:
+            key = str(key, "utf-8")
+        values[key], idx = _decode_bencode_impl(
+            bencoded_value, start_idx, zero_copy, keys_as_bytes
+        )
+        spans[key] = (start_idx, idx)
+    return values, spans
 
 
 def _decode_bencode_impl(
-    input: bytes, start_idx: int
-) -> tuple[int | bytes | list | dict, int]:
-    prefix = input[start_idx]
-    if prefix == BYTE_I:
-        # i123e
-        end_idx = input.index(BYTE_E, start_idx + 2)
-        int_value = int(input[start_idx + 1 : end_idx])
-        return (int_value, end_idx + 1)
-    elif BYTE_0 <= prefix <= BYTE_9:
-        # 3:abc
-        col_idx = input.index(BYTE_COL, start_idx + 1)
-        length = int(input[start_idx:col_idx])
-        end_idx = col_idx + 1 + length
-        str_value = input[col_idx + 1 : end_idx]
-        return (str_value, end_idx)
-    elif prefix == BYTE_L:
-        idx = start_idx + 1
-        list_value = []
-        while input[idx] != BYTE_E:
-            value, next_idx = _decode_bencode_impl(input, idx)
-            list_value.append(value)
-            idx = next_idx
-        return (list_value, idx + 1)
-    elif prefix == BYTE_D:
-        idx = start_idx + 1
-        dict_value = {}
-        while input[idx] != BYTE_E:
-            key, next_idx = _decode_bencode_impl(input, idx)
-            if isinstance(key, bytes):
-                key = str(key, "utf-8")
-            value, next_idx = _decode_bencode_impl(input, next_idx)
-            dict_value[key] = value
-            idx = next_idx
-        return (dict_value, idx + 1)
-    else:
-        raise ValueError(f"Unknown prefix '{chr(prefix)}'")
-
-
-def encode_bencode(value: int | bytes | str | list | dict) -> bytes:
-    if isinstance(value, int):
-        return f"i{value}e".encode()
-    elif isinstance(value, bytes):
-        return f"{len(value)}:".encode() + value
-    elif isinstance(value, str):
-        return f"{len(value)}:{value}".encode()
-    elif isinstance(value, list):
-        result = b"l"
+    input: bytes,
+    start_idx: int,
+    zero_copy: bool = False,
+    keys_as_bytes: bool = False,
+) -> tuple[int | bytes | memoryview | list | dict, int]:
+    view = memoryview(input) if zero_copy else None
+    # The innermost open container lives in locals; enclosing ones are saved on
+    # the stack as (container, is_dict, pending_key) only while nested
+    stack: list[tuple] = []
+    push = stack.append
+    pop = stack.pop
+    container: list | dict | None = None
+    is_dict = False
+    key = None
+    idx = start_idx
+    while True:
+        prefix = input[idx]
+        if prefix == BYTE_I:
+            # i123e
+            end_idx = input.find(BYTE_E, idx + 2)
+            if end_idx < 0:
+                raise ValueError("Missing 'e'")
+            value = int(input[idx + 1 : end_idx])
+            idx = end_idx + 1
+        elif BYTE_0 <= prefix <= BYTE_9:
+            # 3:abc
+            col_idx = input.find(BYTE_COL, idx + 1)
+            if col_idx < 0:
+                raise ValueError("Missing ':'")
+            if col_idx - idx > MAX_LENGTH_DIGITS:
+                raise ValueError("String longer than input")
+            length = int(input[idx:col_idx])
+            end_idx = col_idx + 1 + length
+            if end_idx > len(input):
+                raise ValueError("String longer than input")
+            if zero_copy:
+                value = view[col_idx + 1 : end_idx]
+            else:
+                value = input[col_idx + 1 : end_idx]
+            idx = end_idx
+        elif prefix == BYTE_L or prefix == BYTE_D:
+            if container is not None:
+                push((container, is_dict, key))
+            is_dict = prefix == BYTE_D
+            container = {} if is_dict else []
+            key = None
+            idx += 1
+            continue
+        elif prefix == BYTE_E and container is not None:
+            value = container
+            idx += 1
+            if not stack:
+                return (value, idx)
+            container, is_dict, key = pop()
+        else:
+            raise ValueError(f"Unknown prefix '{chr(prefix)}'")
+
+        if container is None:
+            return (value, idx)
+
+        if not is_dict:
+            container.append(value)
+        elif key is None:
+            if keys_as_bytes:
+                if type(value) is memoryview:
+                    value = bytes(value)
+            elif isinstance(value, (bytes, memoryview)):
+                value = str(value, "utf-8")
+            key = value
+        else:
+            container[key] = value
+            key = None
+
+
+def _sort_key(item: tuple[str | bytes, object]) -> bytes:
+    # Keys must be in raw byte order
+    key = item[0]
+    return key.encode() if type(key) is str else key
+
+
+def encode_bencode(value: int | bytes | memoryview | str | list | dict) -> bytes:
+    parts: list[bytes] = []
+    encode_bencode_into(value, parts.append)
+    return b"".join(parts)
+
+
+def encode_bencode_into(
+    value: int | bytes | memoryview | str | list | dict,
+    out: Callable[[bytes | memoryview], object],
+):
+    if type(value) is int:
+        out(b"i%de" % value)
+    elif type(value) is bytes:
+        out(b"%d:" % len(value))
+        out(value)
+    elif type(value) is memoryview:
+        out(b"%d:" % value.nbytes)
+        out(value)
+    elif type(value) is str:
+        value_b = value.encode()
+        out(b"%d:" % len(value_b))
+        out(value_b)
+    elif type(value) is list:
+        out(b"l")
         for item in value:
-            result += encode_bencode(item)
-        return result + b"e"
-    elif isinstance(value, dict):
-        result = b"d"
-        for key, item_value in value.items():
-            result += encode_bencode(key)
-            result += encode_bencode(item_value)
-        return result + b"e"
+            encode_bencode_into(item, out)
+        out(b"e")
+    elif type(value) is dict:
+        out(b"d")
+        for key, item_value in sorted(value.items(), key=_sort_key):
+            encode_bencode_into(key, out)
+            encode_bencode_into(item_value, out)
+        out(b"e")
     else:
         raise TypeError(f"Can't bencode type {type(value)}")
+
+
+try:
+    from app._bencoding import _decode_bencode_impl, encode_bencode_into
+except ImportError:
+    # Opt-in only: importing Numba and loading its JIT cache costs more than a
+    # single decode saves in this one-shot CLI
+    if environ.get("BENCODE_NUMBA") == "1":
+        from app._bencoding_numba import _decode_bencode_impl
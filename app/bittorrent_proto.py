@@ -1,10 +1,10 @@
 from abc import abstractmethod
-from io import BufferedReader, BufferedRWPair, BufferedWriter
-from socket import AddressFamily, SocketKind, socket
-from struct import pack, unpack
-from typing import ContextManager, Self, overload, override
+from contextlib import AbstractAsyncContextManager
+from functools import cache
+from struct import pack, unpack_from
+from typing import Self, override
 
-from app.communication import Address
+from app.communication import Address, AsyncSocketIO, connect_socket
 from app.metainfo import MetaInfo
 
 # Protocol String
@@ -14,63 +14,38 @@ assert PROTO_NAME_LENGTH == 19
 
 HANDSHAKE_FORMAT = "!B19s8s20s20s"
 HANDSHAKE_LENGTH = 68
+HANDSHAKE_PREFIX = bytes([PROTO_NAME_LENGTH]) + PROTO_NAME
 PAD_8 = b"\x00" * 8
 
 
-class HandshakeMessage(tuple):
-    @overload
-    def __new__(cls, info_hash: bytes, peer_id: bytes): ...
-    @overload
-    def __new__(
-        cls, pnl: int, pn: bytes, pad: bytes, info_hash: bytes, peer_id: bytes
-    ): ...
-    def __new__(cls, *args):
-        info_hash: bytes = args[-2]
-        peer_id: bytes = args[-1]
-        assert len(info_hash) == 20
-        assert len(peer_id) == 20
-        if len(args) == 2:
-            return super().__new__(
-                cls, (PROTO_NAME_LENGTH, PROTO_NAME, PAD_8, info_hash, peer_id)
-            )
-        else:
-            return super().__new__(cls, args)
+@cache
+def pack_handshake(info_hash: bytes, peer_id: bytes) -> bytes:
+    assert len(info_hash) == 20
+    assert len(peer_id) == 20
+    return pack(
+        HANDSHAKE_FORMAT, PROTO_NAME_LENGTH, PROTO_NAME, PAD_8, info_hash, peer_id
+    )
 
-    @property
-    def info_hash(self) -> bytes:
-        return self[3]
-
-    @property
-    def peer_id(self) -> bytes:
-        return self[4]
-
-    def pack(self):
-        return pack(HANDSHAKE_FORMAT, *self)
 
-    @staticmethod
-    def unpack(data: bytes) -> "HandshakeMessage":
-        msg = HandshakeMessage(*unpack(HANDSHAKE_FORMAT, data))
-        assert msg[0] == PROTO_NAME_LENGTH
-        assert msg[1] == PROTO_NAME
-        return msg
+async def send_handshake(io: AsyncSocketIO, info_hash: bytes, peer_id: bytes):
+    await io.write(pack_handshake(info_hash, peer_id))
 
 
-def send_handshake(io: BufferedWriter, info_hash: bytes, peer_id: bytes):
-    msg = HandshakeMessage(info_hash, peer_id)
-    data = msg.pack()
-    send_size = io.write(data)
-    assert send_size == len(data)
-
-
-def recv_handshake(io: BufferedReader) -> HandshakeMessage:
-    data = io.read(HANDSHAKE_LENGTH)
-    if not len(data) == HANDSHAKE_LENGTH:
-        raise ConnectionError("Did not get enough bytes for handshake")
-    return HandshakeMessage.unpack(data)
+async def recv_handshake_peer_id(io: AsyncSocketIO, buf: memoryview) -> bytes:
+    data = buf[:HANDSHAKE_LENGTH]
+    await io.readinto(data)
+    if data[: len(HANDSHAKE_PREFIX)] != HANDSHAKE_PREFIX:
+        raise ConnectionError("Unknown handshake protocol")
+    return bytes(data[48:HANDSHAKE_LENGTH])
 
 
 MSG_HEADER_FORMAT = "!IB"
 MSG_HEADER_LENGTH = 5
+# Control messages are read into a per-connection buffer of this size
+MSG_BUFFER_SIZE = 1 << 12
+# Header of a piece message: length, id, index, begin
+PIECE_HEADER_FORMAT = "!IBII"
+PIECE_HEADER_LENGTH = 13
 
 
 class PeerMsg:
@@ -78,20 +53,14 @@ class PeerMsg:
 
     def _pack_msg(self):
         payload = self._pack_payload()
-        size = len(payload)
-        return pack(
-            f"{MSG_HEADER_FORMAT}{size}s",
-            size + 1,
-            self.MSG_ID,
-            payload,
-        )
+        return pack(MSG_HEADER_FORMAT, len(payload) + 1, self.MSG_ID) + payload
 
     @abstractmethod
     def _pack_payload(self) -> bytes: ...
 
     @classmethod
     @abstractmethod
-    def _unpack_payload(cls, data: bytes) -> Self: ...
+    def _unpack_payload(cls, buf: memoryview, offset: int, length: int) -> Self: ...
 
 
 class UnchokeMsg(PeerMsg):
@@ -103,8 +72,8 @@ class UnchokeMsg(PeerMsg):
 
     @override
     @classmethod
-    def _unpack_payload(cls, data: bytes) -> Self:
-        assert len(data) == 0
+    def _unpack_payload(cls, buf: memoryview, offset: int, length: int) -> Self:
+        assert length == 0
         return UnchokeMsg()
 
 
@@ -117,8 +86,8 @@ class InterestedMsg(PeerMsg):
 
     @override
     @classmethod
-    def _unpack_payload(cls, data: bytes) -> Self:
-        assert len(data) == 0
+    def _unpack_payload(cls, buf: memoryview, offset: int, length: int) -> Self:
+        assert length == 0
         return InterestedMsg()
 
 
@@ -131,8 +100,8 @@ class BitfieldMsg(PeerMsg):
 
     @override
     @classmethod
-    def _unpack_payload(cls, data: bytes) -> Self:
-        # assert len(data) == ?
+    def _unpack_payload(cls, buf: memoryview, offset: int, length: int) -> Self:
+        # assert length == ?
         return BitfieldMsg()
 
 
@@ -150,70 +119,63 @@ class RequestMsg(PeerMsg):
 
     @override
     @classmethod
-    def _unpack_payload(cls, data: bytes) -> Self:
+    def _unpack_payload(cls, buf: memoryview, offset: int, length: int) -> Self:
         raise NotImplementedError("RequestMsg._unpack_payload")
 
 
 class PieceMsg(PeerMsg):
     MSG_ID = 7
 
-    def __init__(self, index: int, begin: int, block: bytes) -> None:
-        self.index = index
-        self.begin = begin
-        self.block = block
-
     @override
     def _pack_payload(self) -> bytes:
         raise NotImplementedError("PieceMsg._pack_payload")
 
-    @override
-    @classmethod
-    def _unpack_payload(cls, data: bytes) -> Self:
-        length = len(data) - 8
-        return PieceMsg(*unpack(f"!II{length}s", data))
-
 
 _MSG_CLASS_MAP: dict[int, PeerMsg] = {
     UnchokeMsg.MSG_ID: UnchokeMsg,
     InterestedMsg.MSG_ID: InterestedMsg,
     BitfieldMsg.MSG_ID: BitfieldMsg,
     RequestMsg.MSG_ID: RequestMsg,
-    PieceMsg.MSG_ID: PieceMsg,
+    # Not PieceMsg, blocks are received straight into the piece by get_piece_into
 }
 
+_MSG_CLASS_TABLE: tuple[type[PeerMsg] | None, ...] = tuple(
+    _MSG_CLASS_MAP.get(id) for id in range(max(_MSG_CLASS_MAP) + 1)
+)
+
 
-def read_msg(io: BufferedReader) -> PeerMsg:
+async def read_msg(io: AsyncSocketIO, buf: memoryview) -> PeerMsg:
     size: int
     id: int
-    header = io.read(MSG_HEADER_LENGTH)
-    if io.closed:
-        raise RuntimeError(f"IO closed")
-    if len(header) != MSG_HEADER_LENGTH:
-        raise ConnectionError(
-            f"Not egnough data, got {len(header)} of {MSG_HEADER_LENGTH}: {header}"
-        )
-
-    size, id = unpack(MSG_HEADER_FORMAT, header)
-    if id not in _MSG_CLASS_MAP:
+    await io.readinto(buf[:MSG_HEADER_LENGTH])
+    size, id = unpack_from(MSG_HEADER_FORMAT, buf)
+    cls = _MSG_CLASS_TABLE[id] if id < len(_MSG_CLASS_TABLE) else None
+    if cls is None:
         raise RuntimeError(f"Unknown message id: {id}")
-    cls = _MSG_CLASS_MAP[id]
-    payload = io.read(size - 1)
-    return cls._unpack_payload(payload)
+    length = size - 1
+    if length > len(buf):
+        buf = memoryview(bytearray(length))
+    await io.readinto(buf[:length])
+    return cls._unpack_payload(buf, 0, length)
+
 
+# For one-off messages such as interested, bursts should use send_msgs
+async def send_msg(io: AsyncSocketIO, msg: PeerMsg):
+    await io.write(msg._pack_msg())
 
-def send_msg(io: BufferedWriter, msg: PeerMsg):
-    data = msg._pack_msg()
-    write_len = io.write(data)
-    assert write_len == len(data)
 
+# Packs the whole burst so it goes out as a single write
+async def send_msgs(io: AsyncSocketIO, msgs: list[PeerMsg]):
+    await io.write(b"".join([msg._pack_msg() for msg in msgs]))
 
-class PeerConnection(ContextManager):
-    _socket: socket | None
-    _io: BufferedRWPair | None
+
+class PeerConnection(AbstractAsyncContextManager):
+    _io: AsyncSocketIO | None
+    _msg_buf: memoryview
     _address: Address
     _meta_info: MetaInfo
     _peer_id: bytes
-    _handshake: HandshakeMessage
+    _remote_peer_id: bytes
     _ready: bool
 
     def __init__(
@@ -221,66 +183,103 @@ class PeerConnection(ContextManager):
         address: Address,
         meta_info: MetaInfo,
         peer_id: bytes,
-        only_handshake=False,
+        io: AsyncSocketIO,
     ):
         self._address = address
         self._meta_info = meta_info
         self._peer_id = peer_id
-        self._socket = None
-        self._io = None
+        self._io = io
+        self._msg_buf = memoryview(bytearray(MSG_BUFFER_SIZE))
         self._ready = False
 
-        self._socket = socket(AddressFamily.AF_INET, SocketKind.SOCK_STREAM)
-        self._socket.connect(address)
-        self._io = self._socket.makefile("brw", buffering=1)
-
+    @classmethod
+    async def connect(
+        cls,
+        address: Address,
+        meta_info: MetaInfo,
+        peer_id: bytes,
+        only_handshake=False,
+    ) -> Self:
+        sock = await connect_socket(address)
+        conn = cls(address, meta_info, peer_id, await AsyncSocketIO.from_socket(sock))
+        try:
+            await conn._init(only_handshake)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def _init(self, only_handshake: bool):
         # Do handshake
-        send_handshake(self._io, self._meta_info.get_info_hash(), self._peer_id)
-        self._handshake = recv_handshake(self._io)
+        info_hash = self._meta_info.get_info_hash()
+        await send_handshake(self._io, info_hash, self._peer_id)
+        self._remote_peer_id = await recv_handshake_peer_id(self._io, self._msg_buf)
 
         if only_handshake:
             return
 
         # Init communication
-        msg = read_msg(self._io)
-        assert isinstance(msg, BitfieldMsg)
-        send_msg(self._io, InterestedMsg())
-        msg = read_msg(self._io)
-        assert isinstance(msg, UnchokeMsg)
+        msg = await read_msg(self._io, self._msg_buf)
+        if not isinstance(msg, BitfieldMsg):
+            raise RuntimeError(f"Expected bitfield message, got id: {msg.MSG_ID}")
+        await send_msg(self._io, InterestedMsg())
+        msg = await read_msg(self._io, self._msg_buf)
+        if not isinstance(msg, UnchokeMsg):
+            raise RuntimeError(f"Expected unchoke message, got id: {msg.MSG_ID}")
 
         self._ready = True
 
     @property
-    def handshake(self) -> HandshakeMessage:
-        return self._handshake
+    def remote_peer_id(self) -> bytes:
+        return self._remote_peer_id
 
-    def get_blocks(self, requests: list[RequestMsg]) -> list[PieceMsg]:
+    async def get_piece_into(
+        self,
+        requests: list[RequestMsg],
+        out: bytearray,
+        piece_offset: int = 0,
+        max_pending: int | None = None,
+    ):
         if not self._ready:
             raise RuntimeError("Can't get parts when not ready")
 
-        for req in requests:
-            send_msg(self._io, req)
+        # Keep up to max_pending requests in flight, refilling as blocks arrive
+        if max_pending is None:
+            max_pending = len(requests)
+        await send_msgs(self._io, requests[:max_pending])
+        next_request = max_pending
 
-        parts: list[PieceMsg] = []
+        io = self._io
+        header = self._msg_buf[:PIECE_HEADER_LENGTH]
+        view = memoryview(out)
         for _ in range(len(requests)):
-            piece = read_msg(self._io)
-            assert isinstance(piece, PieceMsg)
-            parts.append(piece)
-
-        return parts
-
-    def close(self):
+            await io.readinto(header)
+            size, id, index, begin = unpack_from(PIECE_HEADER_FORMAT, header)
+            if id != PieceMsg.MSG_ID:
+                raise RuntimeError(f"Expected piece message, got id: {id}")
+            if index != requests[0].index:
+                raise RuntimeError(f"Expected piece {requests[0].index}, got {index}")
+            if size < PIECE_HEADER_LENGTH - 4:
+                raise RuntimeError(f"Piece message too short: {size}")
+
+            start = piece_offset + begin
+            length = size - (PIECE_HEADER_LENGTH - 4)
+            if start + length > len(view):
+                raise RuntimeError(f"Block out of range: {start}+{length}")
+            await io.readinto(view[start : start + length])
+
+            if next_request < len(requests):
+                await send_msg(self._io, requests[next_request])
+                next_request += 1
+
+    async def close(self):
         self._ready = False
         if self._io:
             self._io.close()
             self._io = None
 
-        if self._socket:
-            self._socket.close()
-            self._socket = None
-
-    def __enter__(self) -> Self:
+    async def __aenter__(self) -> Self:
         return self
 
-    def __exit__(self, *_args, **_kwargs):
-        self.close()
+    async def __aexit__(self, *_args, **_kwargs):
+        await self.close()
@@ -1,13 +1,32 @@
+from asyncio import BufferedProtocol, Future, Transport, get_running_loop
 from contextlib import contextmanager
 from io import BufferedRWPair
-from socket import AddressFamily, SocketKind, socket
+from socket import (
+    IPPROTO_TCP,
+    SO_RCVBUF,
+    SO_SNDBUF,
+    SOL_SOCKET,
+    TCP_NODELAY,
+    AddressFamily,
+    SocketKind,
+    inet_ntoa,
+    socket,
+)
 from struct import iter_unpack
 from typing import Generator
 from urllib.error import HTTPError
 from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+
+from urllib3 import PoolManager
 
 MAX_PORT = 65535
+IO_BUFFER_SIZE = 64 * 1024
+SOCKET_BUFFER_SIZE = 1 << 20
+# Peer connections receive into this, large enough for several 16 KiB blocks
+RECV_BUFFER_SIZE = 256 * 1024
+
+# Keeps tracker connections alive between announces
+_http = PoolManager(maxsize=4)
 
 
 class Address(tuple):
@@ -20,11 +39,12 @@ class Address(tuple):
         return f"{self[0]}:{self[1]}"
 
     @classmethod
-    def from_bytes_to_many(cls, data: bytes) -> Generator["Address", None, None]:
+    def from_bytes_to_many(cls, data: bytes) -> list["Address"]:
         assert len(data) % 6 == 0
-        for ip, port in iter_unpack(cls._STRUCT_FORMAT, data):
-            ip_str = ".".join(repr(b) for b in ip)
-            yield cls(ip_str, port)
+        return [
+            cls(inet_ntoa(ip), port)
+            for ip, port in iter_unpack(cls._STRUCT_FORMAT, data)
+        ]
 
     @classmethod
     def from_str(cls, data: str) -> "Address":
@@ -40,21 +60,126 @@ def get_request(base_url: str, query: dict | None = None):
     if query:
         url = f"{url}?{urlencode(query)}"
 
-    request = Request(
-        url=url,
-        method="GET",
-    )
-    try:
-        with urlopen(request) as res:
-            return res.read()
-    except HTTPError as err:
+    res = _http.request("GET", url)
+    if res.status >= 400:
+        err = HTTPError(url, res.status, res.reason, res.headers, None)
         print(f"Failed request to {url}: {err}")
-        raise
+        raise err
+    return res.data
 
 
 @contextmanager
 def socket_request_rw(address: Address) -> Generator[BufferedRWPair, None, None]:
     with socket(AddressFamily.AF_INET, SocketKind.SOCK_STREAM) as s:
         s.connect(address)
-        with s.makefile("brw", buffering=1) as io:
+        s.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        with s.makefile("brw", buffering=IO_BUFFER_SIZE) as io:
             yield io
+
+
+async def connect_socket(address: Address) -> socket:
+    s = socket(AddressFamily.AF_INET, SocketKind.SOCK_STREAM)
+    try:
+        s.setblocking(False)
+        s.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        # Before connecting so the TCP window can scale to it
+        s.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        s.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        await get_running_loop().sock_connect(s, address)
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+
+class AsyncSocketIO(BufferedProtocol):
+    _transport: Transport | None
+    _buf: memoryview
+    _start: int
+    _end: int
+    _waiter: Future | None
+    _closed: bool
+    _paused: bool
+
+    def __init__(self, buffer_size: int = RECV_BUFFER_SIZE):
+        self._transport = None
+        self._buf = memoryview(bytearray(buffer_size))
+        self._start = 0
+        self._end = 0
+        self._waiter = None
+        self._closed = False
+        self._paused = False
+
+    @classmethod
+    async def from_socket(cls, sock: socket) -> "AsyncSocketIO":
+        _transport, io = await get_running_loop().create_connection(cls, sock=sock)
+        return io
+
+    def connection_made(self, transport: Transport):
+        self._transport = transport
+
+    def connection_lost(self, exc: Exception | None):
+        self._closed = True
+        self._wakeup()
+
+    def eof_received(self) -> bool:
+        self._closed = True
+        self._wakeup()
+        return False
+
+    # The transport receives straight into our preallocated buffer
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._buf[self._end :]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        if self._end == len(self._buf):
+            self._compact()
+            if self._end == len(self._buf):
+                self._transport.pause_reading()
+                self._paused = True
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _compact(self):
+        size = self._end - self._start
+        self._buf[:size] = self._buf[self._start : self._end]
+        self._start = 0
+        self._end = size
+
+    # Copies into the caller's buffer without creating intermediate bytes
+    async def readinto(self, buf: memoryview):
+        size = len(buf)
+        received = 0
+        while True:
+            n = min(self._end - self._start, size - received)
+            buf[received : received + n] = self._buf[self._start : self._start + n]
+            self._start += n
+            received += n
+            if self._start == self._end:
+                self._start = self._end = 0
+                if self._paused:
+                    self._paused = False
+                    self._transport.resume_reading()
+            if received == size:
+                return
+            if self._closed:
+                raise ConnectionError(f"Not egnough data, got {received} of {size}")
+            self._waiter = get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+    async def write(self, data: bytes):
+        if self._closed:
+            raise ConnectionError("Connection closed")
+        self._transport.write(data)
+
+    def close(self):
+        self._closed = True
+        if self._transport is not None:
+            self._transport.close()
@@ -8,6 +8,8 @@ from urllib.parse import parse_qs, urlparse
 
 XT_REGEX = compile(r"urn:(?P<hash_type>bt[im]h):(?P<hash_hex>[0-9a-f]+)", RegexFlag.I)
 
+XT_PREFIXES = ("urn:btih:", "urn:btmh:")
+
 RawMagnetLink = TypedDict(
     "RawMagnetLink", {"xt": str, "dn": str | None, "tr": str | None, "x.pe": str | None}
 )
@@ -23,18 +25,27 @@ class MagnetLink:
 
     @staticmethod
     def from_raw(raw_link: RawMagnetLink) -> Self:
-        xt_match = XT_REGEX.match(raw_link["xt"])
-        assert xt_match
-        groups = xt_match.groupdict()
+        hash_type, hash = _parse_xt(raw_link["xt"])
         return MagnetLink(
-            hash_type=groups["hash_type"],
-            hash=bytes.fromhex(groups["hash_hex"]),
+            hash_type=hash_type,
+            hash=hash,
             file_name=raw_link.get("dn"),
             announce=raw_link.get("tr"),
             peer_address=raw_link.get("x.pe"),
         )
 
 
+def _parse_xt(xt: str) -> tuple[str, bytes]:
+    if xt.startswith(XT_PREFIXES):
+        return (xt[4:8], bytes.fromhex(xt[9:]))
+
+    # Mixed casing
+    xt_match = XT_REGEX.match(xt)
+    assert xt_match
+    groups = xt_match.groupdict()
+    return (groups["hash_type"].lower(), bytes.fromhex(groups["hash_hex"]))
+
+
 def parse_magnet_link(link: str):
     url = urlparse(link)
     assert url.scheme == "magnet"
@@ -1,4 +1,5 @@
 from argparse import ArgumentParser
+from asyncio import run
 from json import dumps
 from pathlib import Path
 from sys import argv
@@ -140,13 +141,16 @@ def main():
         meta_info_file = MetaInfoFile.from_file(args["torrent_file"])
         address = Address.from_str(args["peer_ip_port"])
 
-        result = PeerConnection(
-            address,
-            meta_info_file.info,
-            PEER_ID,
-            only_handshake=True,
-        )
-        print(f"Peer ID: {result.handshake.peer_id.hex()}")
+        async def handshake() -> bytes:
+            async with await PeerConnection.connect(
+                address,
+                meta_info_file.info,
+                PEER_ID,
+                only_handshake=True,
+            ) as conn:
+                return conn.remote_peer_id
+
+        print(f"Peer ID: {run(handshake()).hex()}")
     elif args["command"] == "download_piece":
         meta_info_file = MetaInfoFile.from_file(args["torrent_file"])
         index = args["index"]
@@ -1,24 +1,72 @@
+from collections.abc import Iterator, Sequence
 from dataclasses import dataclass
 from hashlib import sha1
+from typing import overload
 
-from app.bencoding import decode_bencode, encode_bencode
+from app.bencoding import decode_bencode_dict_with_spans, encode_bencode_into
+
+PIECE_HASH_LENGTH = 20
+
+
+class _PieceView(Sequence[memoryview]):
+    def __init__(self, blob: bytes | memoryview) -> None:
+        self._blob = memoryview(blob)
+
+    def __len__(self) -> int:
+        return len(self._blob) // PIECE_HASH_LENGTH
+
+    @overload
+    def __getitem__(self, index: int) -> memoryview: ...
+    @overload
+    def __getitem__(self, index: slice) -> Sequence[memoryview]: ...
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(len(self))[index]
+            if indices.step == 1:
+                start = indices.start * PIECE_HASH_LENGTH
+                stop = max(indices.stop, indices.start) * PIECE_HASH_LENGTH
+                return _PieceView(self._blob[start:stop])
+            return [self[i] for i in indices]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index out of range")
+        start = index * PIECE_HASH_LENGTH
+        return self._blob[start : start + PIECE_HASH_LENGTH]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        blob = self._blob
+        for start in range(0, len(blob), PIECE_HASH_LENGTH):
+            yield blob[start : start + PIECE_HASH_LENGTH]
 
 
 class MetaInfo:
-    def __init__(self, info: dict) -> None:
+    def __init__(self, info: dict, raw_info: bytes | memoryview | None = None) -> None:
         self.length: int = info["length"]
         self.name: str = str(info["name"], "utf-8")
         self.piece_length: int = info["piece length"]
-        self.pieces: list[bytes] = []
-        pieces_b: bytes = info["pieces"]
-        assert len(pieces_b) % 20 == 0
-        for i in range(0, len(pieces_b), 20):
-            self.pieces.append(pieces_b[i : i + 20])
+        self._pieces_blob: bytes | memoryview = info["pieces"]
+        if len(self._pieces_blob) % PIECE_HASH_LENGTH:
+            raise ValueError("Pieces is not a multiple of the hash length")
 
         self._info_dict = info
+        # The info hash must be taken over the bytes exactly as in the torrent
+        self._raw_info = raw_info
+        self._info_hash: bytes | None = None
+
+    @property
+    def pieces(self) -> _PieceView:
+        return _PieceView(self._pieces_blob)
 
-    def get_info_hash(self):
-        return sha1(encode_bencode(self._info_dict)).digest()
+    def get_info_hash(self) -> bytes:
+        if self._info_hash is None:
+            if self._raw_info is not None:
+                self._info_hash = sha1(self._raw_info).digest()
+            else:
+                h = sha1()
+                encode_bencode_into(self._info_dict, h.update)
+                self._info_hash = h.digest()
+        return self._info_hash
 
 
 @dataclass
@@ -31,5 +79,7 @@ class MetaInfoFile:
         with open(file_path, "rb") as f:
             bencoded_data = f.read()
 
-        data = decode_bencode(bencoded_data)
-        return cls(str(data["announce"], "utf-8"), MetaInfo(data["info"]))
+        data, spans = decode_bencode_dict_with_spans(bencoded_data, zero_copy=True)
+        info_start, info_end = spans["info"]
+        raw_info = memoryview(bencoded_data)[info_start:info_end]
+        return cls(str(data["announce"], "utf-8"), MetaInfo(data["info"], raw_info))
@@ -1,16 +1,28 @@
-from hashlib import file_digest, sha1
-from itertools import batched, chain
-from multiprocessing import Process, Queue
+from asyncio import Queue, gather, get_running_loop, run, sleep
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from os import O_CREAT, O_TRUNC, O_WRONLY, close, cpu_count, ftruncate
+from os import open as os_open
+from os import pwrite, replace
 from pathlib import Path
-from shutil import copyfileobj
-from time import sleep
-from typing import cast
 
 from app.bencoding import decode_bencode
-from app.bittorrent_proto import PeerConnection, PieceMsg, RequestMsg
+from app.bittorrent_proto import PeerConnection, RequestMsg
 from app.communication import Address, get_request
 from app.metainfo import MetaInfo, MetaInfoFile
 
+try:
+    from os import posix_fallocate
+except ImportError:
+    # Not available on macOS
+    posix_fallocate = None
+
+BLOCK_SIZE = 16 * 1024
+# Outstanding block requests per peer, enough to cover the bandwidth-delay product
+PIPELINE_DEPTH = 8
+PEER_RETRIES = 3
+PEER_RETRY_DELAY = 0.5
+
 
 ########
 # HTTP #
@@ -25,7 +37,7 @@ class PeersResponse:
         self.complete: int = values["complete"]
         self.incomplete: int = values["incomplete"]
         self.min_interval: int = values["min interval"]
-        self.addresses = list(Address.from_bytes_to_many(values["peers"]))
+        self.addresses = Address.from_bytes_to_many(values["peers"])
 
 
 def fetch_peers(peer_id: bytes, meta_info_file: MetaInfoFile) -> PeersResponse:
@@ -45,13 +57,19 @@ def fetch_peers(peer_id: bytes, meta_info_file: MetaInfoFile) -> PeersResponse:
 
 
 class PieceInfo:
-    def __init__(self, info: MetaInfo, peer_id: bytes, index: int, file_path: Path):
+    def __init__(
+        self,
+        info: MetaInfo,
+        peer_id: bytes,
+        index: int,
+        file_offset: int | None = None,
+    ):
         self.peer_id = peer_id
         self.index = index
-        self.file_path = file_path
-        self.hash = info.pieces[index]
+        self.hash = bytes(info.pieces[index])
         self.begin = info.piece_length * index
         self.length = min(info.piece_length, info.length - self.begin)
+        self.file_offset = self.begin if file_offset is None else file_offset
 
     def get_requests(self, block_size: int):
         next_block = 0
@@ -71,8 +89,7 @@ def download_piece(
     index: int,
     output_file: Path | None,
 ):
-    piece_file = output_file.with_name(output_file.name + f".{index}")
-    piece = PieceInfo(info, peer_id, index, piece_file)
+    piece = PieceInfo(info, peer_id, index, file_offset=0)
     downloader = _Downloader(addresses, info, peer_id, [piece])
     downloader.download(output_file)
 
@@ -86,8 +103,7 @@ def download(
 
     pieces: list[PieceInfo] = []
     for index in range(len(info.pieces)):
-        piece_file = output_file.with_name(output_file.name + f".{index}")
-        pieces.append(PieceInfo(info, peer_id, index, piece_file))
+        pieces.append(PieceInfo(info, peer_id, index))
 
     downloader = _Downloader(addresses, info, peer_id, pieces)
     downloader.download(output_file)
@@ -106,109 +122,112 @@ class _Downloader:
         self.peer_id = peer_id
         self.pieces = pieces
         self.done_pieces: list[PieceInfo | None] = [None] * len(pieces)
+        self._fd = -1
+        self._verify_pool: ThreadPoolExecutor | None = None
 
     def download(self, output_file: Path):
-        queue_size = max(len(self.pieces), len(self.addresses))
-        queue = Queue(queue_size)
-        processes: list[Process] = []
+        # Pieces are written straight to their final offset in a .part file,
+        # which only replaces the output once every piece is verified
+        part_file = output_file.with_name(output_file.name + ".part")
+        self._fd = os_open(part_file, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+        # sha1 releases the GIL, so pieces are verified in parallel off the loop
+        self._verify_pool = ThreadPoolExecutor(max_workers=cpu_count())
+        try:
+            try:
+                _preallocate(self._fd, sum(piece.length for piece in self.pieces))
+                run(self._download())
+            finally:
+                self._verify_pool.shutdown()
+                self._verify_pool = None
+                close(self._fd)
+                self._fd = -1
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        replace(part_file, output_file)
+
+    async def _download(self):
+        queue: Queue[int | None] = Queue()
+        for i in range(len(self.pieces)):
+            queue.put_nowait(i)
+
+        await gather(*(self._peer_loop(address, queue) for address in self.addresses))
+        if not all(self.done_pieces):
+            raise RuntimeError("Peers died")
+
+    async def _peer_loop(self, address: Address, queue: "Queue[int | None]"):
+        for attempt in range(PEER_RETRIES + 1):
+            if attempt:
+                await sleep(PEER_RETRY_DELAY * 2 ** (attempt - 1))
+                if all(self.done_pieces):
+                    return
+            try:
+                await self._peer_session(address, queue)
+                return
+            except OSError as exc:
+                # Transient (includes ConnectionError), reconnect to the same peer
+                print(f"{address!r}: {exc.__class__.__name__}: {exc}")
+            except Exception as exc:
+                # Misbehaving peer, drop it and let the others finish
+                print(f"{address!r}: {exc.__class__.__name__}: {exc}")
+                return
+
+    async def _peer_session(self, address: Address, queue: "Queue[int | None]"):
+        i: int | None = None
         try:
-            for piece in self.pieces:
-                queue.put_nowait(piece)
+            async with await PeerConnection.connect(
+                address, self.info, self.peer_id
+            ) as conn:
+                while True:
+                    i = await queue.get()
+                    if i is None:
+                        return
+                    piece = self.pieces[i]
+                    data = await _fetch_piece(conn, piece)
+                    hash = await get_running_loop().run_in_executor(
+                        self._verify_pool, _sha1_digest, data
+                    )
+                    if hash != piece.hash:
+                        raise RuntimeError("Hash did not match")
+                    _write_at(self._fd, data, piece.file_offset)
+                    self._set_piece_done(i, queue)
+                    i = None
+        finally:
+            if i is not None:
+                queue.put_nowait(i)
 
-            for address in self.addresses:
-                process = self._create_process(address, queue)
-                process.start()
-                processes.append(process)
+    def _set_piece_done(self, i: int, queue: "Queue[int | None]"):
+        self.done_pieces[i] = self.pieces[i]
+        if all(self.done_pieces):
+            # Stop all peer loops
+            for _ in range(len(self.addresses)):
+                queue.put_nowait(None)
 
-            while not all(self.done_pieces):
-                self._check_processes(processes)
-                self._check_pieces()
-        finally:
-            for _ in range(len(processes)):
-                queue.put(None)
-            for process in processes:
-                process.join()
-                process.close()
-            queue.close()
-
-        self._combine_file(output_file)
-
-    def _create_process(self, address: Address, queue: Queue):
-        return Process(
-            name=repr(address),
-            target=_start_worker,
-            args=(address, self.info, self.peer_id, queue),
-        )
-
-    def _check_processes(self, processes: list[Process]):
-        i = 0
-        while i < len(processes):
-            process = processes[i]
-            if not process.is_alive():
-                process.close()
-                processes.pop(i)
-                continue
-            i += 1
-
-        if len(processes) == 0:
-            raise RuntimeError("Processes died")
-
-    def _check_pieces(self):
-        for i, piece in enumerate(self.pieces):
-            if self.done_pieces[i]:
-                continue
-            if not self._is_piece_done(piece):
-                continue
-
-            self.done_pieces[i] = self.pieces[i]
-
-    def _is_piece_done(self, piece: PieceInfo) -> bool:
+
+def _preallocate(fd: int, size: int):
+    if posix_fallocate is not None:
         try:
-            stat = piece.file_path.stat()
-        except FileNotFoundError:
-            return False
-
-        if stat.st_size < piece.length:
-            return False
-        if stat.st_size > piece.length:
-            raise RuntimeError("File was too big")
-
-        with open(piece.file_path, "rb") as f:
-            hash = file_digest(f, "sha1").digest()
-
-        if hash != piece.hash:
-            raise RuntimeError("Hash did not match")
-
-        return True
-
-    def _combine_file(self, output_file: Path):
-        with open(output_file, "wb") as fo:
-            for piece in self.done_pieces:
-                with open(piece.file_path, "rb") as fi:
-                    copyfileobj(fi, fo)
-                piece.file_path.unlink()
-
-
-def _start_worker(address: Address, info: MetaInfo, peer_id: bytes, queue: Queue):
-    piece: PieceInfo | None = None
-    try:
-        with PeerConnection(address, info, peer_id) as conn:
-            while True:
-                piece = cast(PieceInfo | None, queue.get())
-                if not piece:
-                    return
-                _fetch_piece(conn, piece)
-                piece = None
-    except (ValueError, ConnectionError) as exc:
-        print(f"{exc.__class__.__name__}: {exc}")
-    finally:
-        if piece:
-            queue.put_nowait(piece)
-
-
-def _fetch_piece(conn: PeerConnection, piece: PieceInfo):
-    requests = piece.get_requests(16 * 1024)
-    blocks = chain.from_iterable(map(conn.get_blocks, batched(requests, 5)))
-    with open(piece.file_path, "wb") as f:
-        for block in blocks:
-            f.write(block.block)
+            posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by the file system
+            pass
+    ftruncate(fd, size)
+
+
+def _write_at(fd: int, data: bytearray, offset: int):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += pwrite(fd, view[written:], offset + written)
+
+
+def _sha1_digest(data: bytearray) -> bytes:
+    return sha1(data).digest()
+
+
+async def _fetch_piece(conn: PeerConnection, piece: PieceInfo) -> bytearray:
+    requests = piece.get_requests(BLOCK_SIZE)
+    data = bytearray(piece.length)
+    await conn.get_piece_into(requests, data, max_pending=PIPELINE_DEPTH)
+    return data